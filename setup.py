@@ -22,7 +22,8 @@ setup(
     tests_require=tests_require,
     extras_require={
         "test": tests_require,
-        "toml": ["toml >= 0.9.4"]
+        "toml": ["toml >= 0.9.4"],
+        "orjson": ["orjson >= 3.0.0"]
     },
     packages=find_packages(exclude=["test"]),
     include_package_data=True,
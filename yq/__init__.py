@@ -9,28 +9,179 @@ See https://github.com/kislyuk/yq for more information.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import sys, argparse, subprocess, json
+import os, sys, io, argparse, subprocess, threading, json, re, codecs, errno
 from collections import OrderedDict
 from datetime import datetime, date, time
 
-import yaml, argcomplete
+import yaml
 
-from .compat import USING_PYTHON2, open
+from .compat import USING_PYTHON2, open, which
 from .parser import get_parser, jq_arg_spec
-from .loader import get_loader
+from .loader import get_loader, JSONTranscoder
 from .dumper import get_dumper
 from .version import __version__  # noqa
 
+# Size of the buffer in front of jq's stdin pipe (matches the default Linux pipe capacity)
+jq_pipe_bufsize = 64 * 1024
+# Kernel capacity requested for the pipes to and from jq, so that neither side blocks as often
+jq_pipe_capacity = 1024 * 1024
+# Encoded documents are written to jq in batches of about this size, rather than one write per document
+jq_write_batch_size = 256 * 1024
+
+# Bundled single-dash jq options (e.g. -Cy), which may carry our own short options that must be stripped out
+jq_short_opts_re = re.compile(r"^-(?!-)[a-zA-Z]+$")
+# Our short options, plus -C (color output) when jq's output is converted and must not contain escape sequences
+yq_short_opts_re = re.compile(r"[ixyY]")
+yq_short_opts_and_color_re = re.compile(r"[ixyYC]")
+# jq ends each output document with a newline, on a line that is not indented (nested lines of pretty-printed output
+# are), so a partial document in its output can only have been completed once such a line has arrived
+jq_doc_end_re = re.compile(r"^\S[^\n]*\n", re.MULTILINE)
+
 class JSONDateTimeEncoder(json.JSONEncoder):
+    # Exact type lookups cover the objects PyYAML constructs; the isinstance() check catches subclasses
+    isoformat_types = {datetime: datetime.isoformat, date: date.isoformat, time: time.isoformat}
+
     def default(self, o):
+        isoformat = self.isoformat_types.get(type(o))
+        if isoformat is not None:
+            return isoformat(o)
         if isinstance(o, (datetime, date, time)):
             return o.isoformat()
         return json.JSONEncoder.default(self, o)
 
-def decode_docs(jq_output, json_decoder):
-    while jq_output:
-        doc, pos = json_decoder.raw_decode(jq_output)
-        jq_output = jq_output[pos + 1:]
+def load_input_docs(input_streams, input_format, use_annotations=False):
+    for input_stream in input_streams:
+        if input_format == "yaml":
+            loader = get_loader(use_annotations=use_annotations)
+            for doc in yaml.load_all(input_stream, Loader=loader):
+                yield doc
+        elif input_format == "xml":
+            import xmltodict
+            yield xmltodict.parse(input_stream.read(), disable_entities=True)
+        elif input_format == "toml":
+            import toml
+            yield toml.load(input_stream)
+        else:
+            raise Exception("Unknown input format")
+
+def encode_doc(doc):
+    return json.dumps(doc, cls=JSONDateTimeEncoder).encode()
+
+def encode_input_docs(input_streams, input_format, use_annotations=False):
+    if input_format == "yaml" and not use_annotations:
+        # Annotations need the composed YAML nodes, so only plain loading can be transcoded straight to JSON
+        json_encoder = JSONDateTimeEncoder()
+        for input_stream in input_streams:
+            for doc in JSONTranscoder(input_stream, json_encoder):
+                yield doc.encode()
+    else:
+        encode = encode_doc
+        if input_format == "xml":
+            # XML documents only hold strings and nulls, which orjson encodes the same way as the json module (it
+            # differs on non-finite floats and integers beyond 64 bits, so it is not used for the other formats)
+            try:
+                import orjson
+                encode = orjson.dumps
+            except ImportError:
+                pass
+        for doc in load_input_docs(input_streams, input_format, use_annotations=use_annotations):
+            yield encode(doc)
+
+def set_pipe_capacity(pipe, capacity):
+    # Best effort: F_SETPIPE_SZ is Linux-only, and unprivileged users are capped at /proc/sys/fs/pipe-max-size
+    if pipe is None or not sys.platform.startswith("linux"):
+        return
+    import fcntl
+    try:
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), capacity)
+    except (IOError, OSError):
+        pass
+
+def batch_docs(encoded_docs, batch_size=jq_write_batch_size):
+    batch = bytearray()
+    try:
+        for doc in encoded_docs:
+            batch += doc
+            batch += b"\n"
+            if len(batch) >= batch_size:
+                yield bytes(batch)
+                del batch[:]
+    except Exception:
+        # Documents loaded before an error in a later one still go to jq, before the error is reported
+        if batch:
+            yield bytes(batch)
+        raise
+    if batch:
+        yield bytes(batch)
+
+def feed(jq, input_chunks, errors):
+    try:
+        for chunk in input_chunks:
+            jq.stdin.write(chunk)
+    except (IOError, OSError) as e:
+        # jq exited without reading all of its input (EINVAL is how Windows reports it); its exit status tells the rest
+        # of the story
+        if e.errno not in (errno.EPIPE, errno.EINVAL):
+            errors.append(e)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            jq.stdin.close()
+        except (IOError, OSError):
+            pass
+
+def communicate(jq, input_chunks):
+    # Like Popen.communicate(), but jq is fed from an iterator of input chunks by a producer thread while its decoded
+    # output is yielded in chunks as it arrives. Neither the whole input nor the whole output is ever held in memory,
+    # and loading the input overlaps with jq's processing and with the conversion of its output.
+    feed_errors = []
+    feeder = threading.Thread(target=feed, args=(jq, input_chunks, feed_errors))
+    feeder.daemon = True
+    feeder.start()
+    output_decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for data in iter(lambda: os.read(jq.stdout.fileno(), jq_pipe_bufsize), b""):
+            yield output_decoder.decode(data)
+        yield output_decoder.decode(b"", final=True)
+    finally:
+        # If the consumer stops early, closing jq's stdout makes jq exit, which in turn stops the feeder
+        jq.stdout.close()
+        feeder.join()
+        jq.wait()
+    if feed_errors:
+        raise feed_errors[0]
+
+def get_fileno(stream):
+    try:
+        return stream.fileno()
+    except (AttributeError, ValueError):
+        return None
+
+def decode_docs(jq_output_chunks, json_decoder):
+    # Documents are decoded as soon as they are fully buffered. Decoding by offset avoids copying the buffer per
+    # document, and a failed attempt on a partial document is only retried once a line that may end it has arrived.
+    buf, retry_from = "", 0
+    for chunk in jq_output_chunks:
+        buf += chunk
+        if jq_doc_end_re.search(buf, retry_from) is None:
+            continue
+        pos = 0
+        while pos < len(buf):
+            try:
+                doc, end = json_decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            if end == len(buf) or not buf[end].isspace():
+                break  # A document cut short (e.g. "1." of "1.25") may still decode as a shorter one
+            pos = end + 1
+            yield doc
+        buf = buf[pos:]
+        retry_from = buf.rfind("\n") + 1
+    pos = 0
+    while pos < len(buf):
+        doc, pos = json_decoder.raw_decode(buf, pos)
+        pos += 1
         yield doc
 
 def xq_cli():
@@ -40,61 +191,62 @@ def tq_cli():
     cli(input_format="toml", program_name="tq")
 
 class DeferredOutputStream:
+    # Output is produced while the input file is still being read, and an error may cut it short, so it is kept in
+    # memory and only written over the file on close()
     def __init__(self, name, mode="w"):
         self.name = name
         self.mode = mode
-        self._fh = None
-
-    @property
-    def fh(self):
-        if self._fh is None:
-            self._fh = open(self.name, self.mode)
-        return self._fh
+        self._buffer = io.StringIO()
 
     def flush(self):
-        if self._fh is not None:
-            return self.fh.flush()
+        pass
 
     def close(self):
-        if self._fh is not None:
-            return self.fh.close()
+        with open(self.name, self.mode) as fh:
+            fh.write(self._buffer.getvalue())
 
     def __getattr__(self, a):
-        return getattr(self.fh, a)
+        return getattr(self._buffer, a)
 
 def cli(args=None, input_format="yaml", program_name="yq"):
     parser = get_parser(program_name, __doc__)
-    argcomplete.autocomplete(parser)
+    if "_ARGCOMPLETE" in os.environ:
+        # Only import argcomplete when the shell is asking for completions; it is not needed otherwise
+        import argcomplete
+        argcomplete.autocomplete(parser)
     args, jq_args = parser.parse_known_args(args=args)
 
     for i, arg in enumerate(jq_args):
-        if arg.startswith("-") and not arg.startswith("--"):
-            if "i" in arg:
-                args.in_place = True
-            if "y" in arg:
-                args.output_format = "yaml"
-            elif "Y" in arg:
-                args.output_format = "annotated_yaml"
-            elif "x" in arg:
-                args.output_format = "xml"
-            jq_args[i] = arg.replace("i", "").replace("x", "").replace("y", "").replace("Y", "")
+        if not jq_short_opts_re.match(arg):
+            continue
+        if "i" in arg:
+            args.in_place = True
+        if "y" in arg:
+            args.output_format = "yaml"
+        elif "Y" in arg:
+            args.output_format = "annotated_yaml"
+        elif "x" in arg:
+            args.output_format = "xml"
         if args.output_format != "json":
-            jq_args[i] = jq_args[i].replace("C", "")
-            if jq_args[i] == "-":
-                jq_args[i] = None
+            jq_args[i] = yq_short_opts_and_color_re.sub("", arg)
+        else:
+            jq_args[i] = yq_short_opts_re.sub("", arg)
+        if jq_args[i] == "-":
+            jq_args[i] = None
 
     jq_args = [arg for arg in jq_args if arg is not None]
 
     for arg in jq_arg_spec:
         values = getattr(args, arg, None)
-        delattr(args, arg)
         if values is not None:
             for value_group in values:
                 jq_args.append(arg)
                 jq_args.extend(value_group)
 
     if "--from-file" in jq_args or "-f" in jq_args:
-        args.input_streams.insert(0, argparse.FileType()(args.jq_filter))
+        # The filter comes from a file, so the first positional is an input; build a new list rather than inserting into
+        # the parsed one, which is argparse's default list when no files were given
+        args.input_streams = [argparse.FileType()(args.jq_filter)] + args.input_streams
     else:
         jq_filter_arg_loc = len(jq_args)
         if "--args" in jq_args:
@@ -102,36 +254,38 @@ def cli(args=None, input_format="yaml", program_name="yq"):
         elif "--jsonargs" in jq_args:
             jq_filter_arg_loc = jq_args.index('--jsonargs') + 1
         jq_args.insert(jq_filter_arg_loc, args.jq_filter)
-    delattr(args, "jq_filter")
-    in_place = args.in_place
-    delattr(args, "in_place")
 
     if sys.stdin.isatty() and not args.input_streams:
         return parser.print_help()
 
-    yq_args = dict(input_format=input_format, program_name=program_name, jq_args=jq_args, **vars(args))
-    if in_place:
+    # Everything left in the namespace besides what was folded into jq_args or is handled here is a yq() argument
+    cli_only_args = set(jq_arg_spec) | {"jq_filter", "in_place"}
+    yq_args = {k: v for k, v in vars(args).items() if k not in cli_only_args}
+    yq_args.update(input_format=input_format, program_name=program_name, jq_args=jq_args)
+    if args.in_place:
         if USING_PYTHON2:
             sys.exit("{}: -i/--in-place is not compatible with Python 2".format(program_name))
         if args.output_format not in {"yaml", "annotated_yaml"}:
             sys.exit("{}: -i/--in-place can only be used with -y/-Y".format(program_name))
         input_streams = yq_args.pop("input_streams")
-        if len(input_streams) == 1 and input_streams[0].name == "<stdin>":
+        if len(input_streams) == 1 and input_streams[0] is sys.stdin:
             msg = "{}: -i/--in-place can only be used with filename arguments, not on standard input"
             sys.exit(msg.format(program_name))
-        for i, input_stream in enumerate(input_streams):
-            def exit_handler(arg=None):
-                if arg:
-                    sys.exit(arg)
-            if i < len(input_streams):
-                yq_args["exit_func"] = exit_handler
-            yq(input_streams=[input_stream], output_stream=DeferredOutputStream(input_stream.name), **yq_args)
+
+        def exit_handler(arg=None):
+            if arg:
+                sys.exit(arg)
+        yq_args["exit_func"] = exit_handler
+        for input_stream in input_streams:
+            output_stream = DeferredOutputStream(input_stream.name)
+            yq(input_streams=[input_stream], output_stream=output_stream, **yq_args)
+            output_stream.close()
     else:
         yq(**yq_args)
 
 def yq(input_streams=None, output_stream=None, input_format="yaml", output_format="json",
        program_name="yq", width=None, indentless_lists=False, xml_root=None, xml_dtd=False,
-       jq_args=frozenset(), exit_func=None):
+       jq_args=(), exit_func=None):
     if not input_streams:
         input_streams = [sys.stdin]
     if not output_stream:
@@ -139,49 +293,59 @@ def yq(input_streams=None, output_stream=None, input_format="yaml", output_forma
     if not exit_func:
         exit_func = sys.exit
     converting_output = True if output_format != "json" else False
+    jq_stdout = subprocess.PIPE if converting_output else None
+    if not converting_output and output_stream is not sys.stdout:
+        # JSON output needs no conversion, so jq writes it straight into the output stream's file if it has one
+        jq_stdout = get_fileno(output_stream)
+        if jq_stdout is None:
+            jq_stdout = subprocess.PIPE
+        else:
+            output_stream.flush()
+
+    # subprocess only spawns with posix_spawn() (vfork + exec, no fork error pipe round trip) given a path to the
+    # executable; argv[0] stays "jq" as jq uses it in its messages. If jq cannot be found, Popen reports it as before.
+    jq_executable = which("jq") or "jq"
+    jq_argv = ["jq"]
+    jq_argv.extend(jq_args)
 
     try:
-        # Note: universal_newlines is just a way to induce subprocess to make stdin a text buffer and encode it for us
-        jq = subprocess.Popen(["jq"] + list(jq_args),
+        # Documents are encoded to bytes up front, so jq's stdin is a plain binary pipe with a large write buffer.
+        # File descriptors opened by Python are not inheritable (PEP 446), so there is no need to pay for closing every
+        # descriptor in the child; this also lets subprocess use posix_spawn() where it can.
+        jq = subprocess.Popen(jq_argv,
+                              executable=jq_executable,
                               stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE if converting_output else None,
-                              universal_newlines=True)
+                              stdout=jq_stdout,
+                              bufsize=jq_pipe_bufsize,
+                              close_fds=False)
     except OSError as e:
         msg = "{}: Error starting jq: {}: {}. Is jq installed and available on PATH?"
         exit_func(msg.format(program_name, type(e).__name__, e))
 
+    jq_out, output_docs = None, None
     try:
+        set_pipe_capacity(jq.stdin, jq_pipe_capacity)
+        set_pipe_capacity(jq.stdout, jq_pipe_capacity)
         if converting_output:
-            # TODO: enable true streaming in this branch (with asyncio, asyncproc, a multi-shot variant of
-            # subprocess.Popen._communicate, etc.)
-            # See https://stackoverflow.com/questions/375427/non-blocking-read-on-a-subprocess-pipe-in-python
             use_annotations = True if output_format == "annotated_yaml" else False
-            input_docs = []
-            for input_stream in input_streams:
-                if input_format == "yaml":
-                    loader = get_loader(use_annotations=use_annotations)
-                    input_docs.extend(yaml.load_all(input_stream, Loader=loader))
-                elif input_format == "xml":
-                    import xmltodict
-                    input_docs.append(xmltodict.parse(input_stream.read(), disable_entities=True))
-                elif input_format == "toml":
-                    import toml
-                    input_docs.append(toml.load(input_stream))
-                else:
-                    raise Exception("Unknown input format")
-            input_payload = "\n".join(json.dumps(doc, cls=JSONDateTimeEncoder) for doc in input_docs)
-            jq_out, jq_err = jq.communicate(input_payload)
-            json_decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+            input_docs = encode_input_docs(input_streams, input_format, use_annotations=use_annotations)
+            jq_out = communicate(jq, batch_docs(input_docs))
+            if sys.version_info >= (3, 7):
+                # dicts preserve insertion order, so the Python-level object_pairs_hook call per object can be skipped
+                json_decoder = json.JSONDecoder()
+            else:
+                json_decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+            output_docs = decode_docs(jq_out, json_decoder)
             if output_format == "yaml" or output_format == "annotated_yaml":
-                yaml.dump_all(decode_docs(jq_out, json_decoder), stream=output_stream,
+                yaml.dump_all(output_docs, stream=output_stream,
                               Dumper=get_dumper(use_annotations=use_annotations, indentless=indentless_lists),
                               width=width, allow_unicode=True, default_flow_style=False)
             elif output_format == "xml":
                 import xmltodict
-                for doc in decode_docs(jq_out, json_decoder):
+                for doc in output_docs:
                     if xml_root:
                         doc = {xml_root: doc}
-                    elif not isinstance(doc, OrderedDict):
+                    elif not isinstance(doc, dict):
                         msg = ("{}: Error converting JSON to XML: cannot represent non-object types at top level. "
                                "Use --xml-root=name to envelope your output with a root element.")
                         exit_func(msg.format(program_name))
@@ -197,8 +361,8 @@ def yq(input_streams=None, output_stream=None, input_format="yaml", output_forma
                     output_stream.write(b"\n" if sys.version_info < (3, 0) else "\n")
             elif output_format == "toml":
                 import toml
-                for doc in decode_docs(jq_out, json_decoder):
-                    if not isinstance(doc, OrderedDict):
+                for doc in output_docs:
+                    if not isinstance(doc, dict):
                         msg = "{}: Error converting JSON to TOML: cannot represent non-object types at top level."
                         exit_func(msg.format(program_name))
 
@@ -209,30 +373,34 @@ def yq(input_streams=None, output_stream=None, input_format="yaml", output_forma
                     else:
                         # For Python 3, write the unicode to the buffer directly.
                         toml.dump(doc, output_stream)
+        elif jq.stdout is not None:
+            jq_out = communicate(jq, batch_docs(encode_input_docs(input_streams, input_format)))
+            for chunk in jq_out:
+                output_stream.write(chunk)
         else:
-            if input_format == "yaml":
-                loader = get_loader(use_annotations=False)
-                for input_stream in input_streams:
-                    for doc in yaml.load_all(input_stream, Loader=loader):
-                        json.dump(doc, jq.stdin, cls=JSONDateTimeEncoder)
-                        jq.stdin.write("\n")
-            elif input_format == "xml":
-                import xmltodict
-                for input_stream in input_streams:
-                    json.dump(xmltodict.parse(input_stream.read(), disable_entities=True), jq.stdin)
-                    jq.stdin.write("\n")
-            elif input_format == "toml":
-                import toml
-                for input_stream in input_streams:
-                    json.dump(toml.load(input_stream), jq.stdin)
-                    jq.stdin.write("\n")
-            else:
-                raise Exception("Unknown input format")
-
-            jq.stdin.close()
-            jq.wait()
+            try:
+                for chunk in batch_docs(encode_input_docs(input_streams, input_format)):
+                    jq.stdin.write(chunk)
+            finally:
+                jq.stdin.close()
+                jq.wait()
         for input_stream in input_streams:
             input_stream.close()
         exit_func(jq.returncode)
     except Exception as e:
         exit_func("{}: Error running jq: {}: {}.".format(program_name, type(e).__name__, e))
+    finally:
+        # Leaving early (e.g. through exit_func) would leave the output generators suspended; closing them stops jq and
+        # the feeder thread, and reaps jq
+        for generator in output_docs, jq_out:
+            if generator is not None:
+                generator.close()
+        # A generator that never started has not started the feeder either, so jq may still be waiting on its input
+        # (or blocked writing output that nobody reads)
+        for pipe in jq.stdin, jq.stdout:
+            if pipe is not None and not pipe.closed:
+                try:
+                    pipe.close()
+                except (IOError, OSError):
+                    pass
+        jq.wait()
@@ -5,8 +5,10 @@ import sys, io
 USING_PYTHON2 = True if sys.version_info < (3, 0) else False
 
 if USING_PYTHON2:
+    from distutils.spawn import find_executable as which
     str = unicode  # noqa
     open = io.open
 else:
+    from shutil import which  # noqa
     str = str
     open = open
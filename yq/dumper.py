@@ -18,7 +18,14 @@ class OrderedDumper(yaml.SafeDumper):
 yaml_value_annotation_re = re.compile(r"^__yq_(?P<type>tag|style)_(?P<key>.+)__$")
 yaml_item_annotation_re = re.compile(r"^__yq_(?P<type>tag|style)_(?P<key>\d+)_(?P<value>.+)__$")
 
+# Dumper classes are built once per configuration and reused, each as its own subclass since representers are
+# registered on the class (see loader.get_loader)
+dumpers = {}
+
 def get_dumper(use_annotations=False, indentless=False):
+    if (use_annotations, indentless) in dumpers:
+        return dumpers[use_annotations, indentless]
+
     def represent_dict(dumper, data):
         pairs, custom_styles, custom_tags = [], {}, {}
         for k, v in data.items():
@@ -68,7 +75,11 @@ def get_dumper(use_annotations=False, indentless=False):
                     v.tag = custom_tags[str(i)]
         return sequence
 
-    dumper = OrderedIndentlessDumper if indentless else OrderedDumper
-    dumper.add_representer(OrderedDict, represent_dict)
-    dumper.add_representer(list, represent_list)
-    return dumper
+    class Dumper(OrderedIndentlessDumper if indentless else OrderedDumper):
+        pass
+
+    Dumper.add_representer(dict, represent_dict)
+    Dumper.add_representer(OrderedDict, represent_dict)
+    Dumper.add_representer(list, represent_list)
+    dumpers[use_annotations, indentless] = Dumper
+    return Dumper
@@ -1,6 +1,12 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import yaml
+from yaml.composer import ComposerError
+from yaml.constructor import SafeConstructor, ConstructorError
+from yaml.events import (AliasEvent, ScalarEvent, SequenceStartEvent, SequenceEndEvent, MappingStartEvent,
+                         MappingEndEvent, StreamEndEvent)
+from yaml.nodes import ScalarNode
+from yaml.resolver import Resolver
 from base64 import b64encode
 from collections import OrderedDict
 from hashlib import sha224
@@ -10,10 +16,22 @@ from .compat import str
 def hash_key(key):
     return b64encode(sha224(key.encode() if isinstance(key, str) else key).digest()).decode()
 
-class OrderedLoader(yaml.SafeLoader):
+try:
+    from yaml import CSafeLoader as default_loader
+except ImportError:
+    from yaml import SafeLoader as default_loader
+
+class OrderedLoader(default_loader):
     pass
 
+# Loader classes are built once per configuration and reused. Each configuration gets its own subclass, since
+# constructors are registered on the class; loader instances (and their state) are still created per load_all() call.
+loaders = {}
+
 def get_loader(use_annotations=False):
+    if use_annotations in loaders:
+        return loaders[use_annotations]
+
     def construct_sequence(loader, node):
         annotations = []
         for i, v_node in enumerate(node.value):
@@ -52,7 +70,148 @@ def get_loader(use_annotations=False):
         elif isinstance(node, yaml.nodes.MappingNode):
             return construct_mapping(loader, node)
 
-    OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
-    OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, construct_sequence)
-    OrderedLoader.add_multi_constructor('', parse_unknown_tags)
-    return OrderedLoader
+    class Loader(OrderedLoader):
+        pass
+
+    Loader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
+    Loader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, construct_sequence)
+    Loader.add_multi_constructor('', parse_unknown_tags)
+    loaders[use_annotations] = Loader
+    return Loader
+
+# Converts a YAML stream to JSON text directly from parser events, yielding one JSON document per YAML document.
+# Only scalars are constructed as Python objects; the output is equivalent to encoding the documents loaded with
+# get_loader() using json_encoder.
+class JSONTranscoder(object):
+    str_tag = "tag:yaml.org,2002:str"
+    merge_tag = "tag:yaml.org,2002:merge"
+    pair_list_tags = {"tag:yaml.org,2002:omap", "tag:yaml.org,2002:pairs"}
+    set_tag = "tag:yaml.org,2002:set"
+    scalar_constructor = SafeConstructor()
+    resolver = Resolver()
+
+    def __init__(self, stream, json_encoder):
+        self.parser = default_loader(stream)
+        self.encode = json_encoder.encode
+        self.anchors = {}
+
+    def __iter__(self):
+        parser = self.parser
+        try:
+            parser.get_event()  # StreamStartEvent
+            while not parser.check_event(StreamEndEvent):
+                parser.get_event()  # DocumentStartEvent
+                self.anchors = {}
+                text, pairs = self.transcode_node(parser.get_event())
+                parser.get_event()  # DocumentEndEvent
+                yield text
+        finally:
+            parser.dispose()
+
+    def transcode_node(self, event):
+        # Returns the node's JSON text, and for mappings also its "key:value" members so that they can be merged
+        pairs, item_pairs = None, None
+        if isinstance(event, AliasEvent):
+            if event.anchor not in self.anchors:
+                raise ComposerError(None, None, "found undefined alias %r" % event.anchor, event.start_mark)
+            return self.anchors[event.anchor][:2]
+        elif isinstance(event, ScalarEvent):
+            text = self.transcode_scalar(event)
+        elif isinstance(event, SequenceStartEvent):
+            items = []
+            # Anchored sequences also keep their items' members, in case they are merged through an alias
+            if event.anchor is not None:
+                item_pairs = []
+            while not self.parser.check_event(SequenceEndEvent):
+                if event.tag in self.pair_list_tags:
+                    text, pairs = self.transcode_pair(event, self.parser.get_event()), None
+                else:
+                    text, pairs = self.transcode_node(self.parser.get_event())
+                items.append(text)
+                if item_pairs is not None:
+                    item_pairs.append(pairs)
+            self.parser.get_event()
+            text, pairs = "[" + ",".join(items) + "]", None
+        elif isinstance(event, MappingStartEvent):
+            pairs = self.transcode_mapping_pairs(event)
+            text = "{" + ",".join(pairs) + "}"
+        if event.anchor is not None:
+            self.anchors[event.anchor] = text, pairs, item_pairs
+        return text, pairs
+
+    def transcode_scalar(self, event):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = self.resolver.resolve(ScalarNode, event.value, event.implicit)
+        if tag == self.str_tag:
+            return self.encode(event.value)
+        construct = self.scalar_constructor.yaml_constructors.get(tag)
+        if construct is None:
+            # Unknown tags are loaded as plain strings (see parse_unknown_tags in get_loader)
+            return self.encode(event.value)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style)
+        return self.encode(construct(self.scalar_constructor, node))
+
+    def transcode_pair(self, event, item_event):
+        # !!omap and !!pairs items are loaded as (key, value) tuples, which encode as two-item arrays
+        if isinstance(item_event, MappingStartEvent) and not self.parser.check_event(MappingEndEvent):
+            pair = self.transcode_node(self.parser.get_event())[0], self.transcode_node(self.parser.get_event())[0]
+            if self.parser.check_event(MappingEndEvent):
+                self.parser.get_event()
+                return "[" + ",".join(pair) + "]"
+        raise ConstructorError("while constructing an ordered map", event.start_mark,
+                               "expected a single mapping item", item_event.start_mark)
+
+    def transcode_key(self, event):
+        text = self.transcode_node(event)[0]
+        if text[0] in "[{":
+            raise ConstructorError("while constructing a mapping", event.start_mark,
+                                   "found a collection as a key, which cannot be represented in JSON", event.end_mark)
+        # Non-string scalar keys are stringified the same way json.dumps() does it
+        return text if text[0] == '"' else self.encode(text)
+
+    def transcode_mapping_pairs(self, event):
+        parser, merge, pairs = self.parser, [], []
+        if event.tag == self.set_tag:
+            raise TypeError("Object of type set is not JSON serializable")
+        while not parser.check_event(MappingEndEvent):
+            key_event = parser.get_event()
+            if isinstance(key_event, ScalarEvent) and self.is_merge_key(key_event):
+                merge.extend(self.transcode_merge_pairs(event, parser.get_event()))
+                continue
+            key = self.transcode_key(key_event)
+            pairs.append(key + ":" + self.transcode_node(parser.get_event())[0])
+        parser.get_event()
+        # As in SafeConstructor.flatten_mapping, merged keys go first so that explicit keys override them
+        return merge + pairs
+
+    def transcode_merge_pairs(self, event, value_event):
+        if isinstance(value_event, SequenceStartEvent):
+            submerge = []
+            while not self.parser.check_event(SequenceEndEvent):
+                submerge.append(self.expect_mapping_pairs(event, self.parser.get_event(),
+                                                          "expected a mapping for merging"))
+            self.parser.get_event()
+            if value_event.anchor is not None:
+                text = "[" + ",".join("{" + ",".join(p) + "}" for p in submerge) + "]"
+                self.anchors[value_event.anchor] = text, None, submerge
+        elif isinstance(value_event, AliasEvent) and self.anchors.get(value_event.anchor, (None,) * 3)[2] is not None:
+            submerge = self.anchors[value_event.anchor][2]
+            if None in submerge:
+                raise ConstructorError("while constructing a mapping", event.start_mark,
+                                       "expected a mapping for merging", value_event.start_mark)
+        else:
+            return self.expect_mapping_pairs(event, value_event, "expected a mapping or list of mappings for merging")
+        return [pair for pairs in reversed(submerge) for pair in pairs]
+
+    def expect_mapping_pairs(self, event, value_event, problem):
+        text, pairs = self.transcode_node(value_event)
+        if pairs is None:
+            raise ConstructorError("while constructing a mapping", event.start_mark, problem, value_event.start_mark)
+        return pairs
+
+    def is_merge_key(self, event):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = self.resolver.resolve(ScalarNode, event.value, event.implicit)
+        return tag == self.merge_tag